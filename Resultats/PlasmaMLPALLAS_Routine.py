@@ -1,28 +1,23 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
 import uproot
+import awkward as ak
+import matplotlib
+matplotlib.use("Agg")  # sauvegarde des figures uniquement, pas d'affichage
 import matplotlib.pyplot as plt
-from matplotlib.colors import LogNorm
+from matplotlib.ticker import FixedLocator, FuncFormatter
 import numpy as np
+try:
+    from numba import njit, prange
+except ImportError:  # sans Numba : repli sur les versions NumPy ci-dessous
+    njit = None
+from fast_histogram import histogram2d
+try:
+    import cupy as cp
+except ImportError:  # sans GPU : tout le remplissage reste sur fast_histogram
+    cp = None
 import gc
 
-# --- Ouvrir fichier ROOT ---
-file = uproot.open(r"a.root")
-
-# --- Charger les trees ---
-tree_input = file["Input"]
-data_input = tree_input.arrays(library="np")
-
-tree_quads = file["QuadrupolesTracking"]
-data_quads = tree_quads.arrays(library="np")
-
-tree_horizontalcoll = file["Horizontal_Coll"]
-data_horizontalcoll = tree_horizontalcoll.arrays(library="np")
-
-tree_verticalcoll = file["Vertical_Coll"]
-data_verticalcoll = tree_verticalcoll.arrays(library="np")
-
-tree_yag = file["BSPECYAG"]
-data_yag = tree_yag.arrays(library="np")
-
 # --- Paramètres ---
 pos_lim = (-5, 5)              # mm
 angle_lim_mrad = (-5, 5)       # mrad pour emittance
@@ -32,20 +27,114 @@ bins_angle = 500  # binning plus fin pour angles
 quads = ["Q1", "Q2", "Q3", "Q4"]
 stages = ["Begin", "End"]
 
+step_size = "100 MB"           # taille des blocs lus par uproot.iterate
+gpu_min_entries = 500_000      # en dessous, le transfert vers le GPU ne vaut pas le coût
+n_workers = os.cpu_count() or 4  # threads de décompression/interprétation uproot
+
+# --- Branches utilisées (lecture partielle des trees) ---
+branches_input = ["x", "z", "xp", "zp"]
+branches_quads = [f"{q}{stage}{var}" for q in quads for stage in stages
+                  for var in ["Pos_x", "Pos_z", "Mom_x", "Mom_y", "Mom_z"]]
+branches_coll = ["x_interaction", "z_interaction"]
+branches_yag = ["x_exit", "z_exit", "energy"]
+
+# --- Ouvrir fichier ROOT ---
+# Exécuteurs attachés au fichier : toutes les lectures (iterate, array) en profitent.
+# uproot libère le GIL pendant la décompression, les baskets d'un bloc sont donc
+# décompressées en parallèle. Pas de cache de tableaux : chaque branche n'est lue
+# qu'une fois ; les objets TTree/TBranch et leurs interprétations restent en cache.
+decompression_executor = uproot.ThreadPoolExecutor(max_workers=n_workers)
+interpretation_executor = uproot.ThreadPoolExecutor(max_workers=n_workers)
+file = uproot.open(r"a.root", object_cache=100, array_cache=None,
+                   decompression_executor=decompression_executor,
+                   interpretation_executor=interpretation_executor)
+
+# --- Trees ---
+tree_input = file["Input"]
+tree_quads = file["QuadrupolesTracking"]
+tree_horizontalcoll = file["Horizontal_Coll"]
+tree_verticalcoll = file["Vertical_Coll"]
+tree_yag = file["BSPECYAG"]
+
 # --- Fonctions de calcul ---
-def compute_emittance_and_twiss(x, theta):
-    mask = (
-        np.isfinite(x) & np.isfinite(theta) &
-        (x >= pos_lim[0]) & (x <= pos_lim[1]) &
-        (theta >= angle_lim_mrad[0]) & (theta <= angle_lim_mrad[1])
-    )
-    x = x[mask]
-    theta = theta[mask]
-    if len(x) < 2:
+# Les statistiques sont accumulées bloc par bloc sous forme de sommes :
+# (n, Σx, Σx²) pour le RMS et (n, Σx, Σθ, Σx², Σθ², Σxθ) pour l'emittance,
+# regroupées par phase_space_moments dans l'ordre RMS x, RMS z, emittance X, Z.
+# Les entrées sont en float32 (pour le binning) ; les sommes sont toujours en float64.
+if njit is not None:
+    # fastmath sans 'nnan'/'ninf' : les comparaisons doivent continuer à rejeter NaN/inf
+    fastmath_flags = {"nsz", "arcp", "contract", "afn", "reassoc"}
+    # prange : les accumulateurs scalaires (+=) sont réduits automatiquement entre threads
+
+    @njit(parallel=True, cache=True, fastmath=fastmath_flags)
+    def phase_space_moments(x, z, tx, tz, xmin, xmax, tmin, tmax):
+        # RMS x/z et emittances X/Z en un seul balayage des quatre tableaux,
+        # sans masque booléen ni copie compactée
+        nx = nz = nex = nez = 0
+        sx = sxx = sz = szz = 0.0
+        ex = etx = exx = etxx = extx = 0.0
+        ez = etz = ezz = etzz = eztz = 0.0
+        for i in prange(x.size):
+            # Produits en float64 : xi*xi en float32 fausse Σx² - n·m² si le faisceau est décentré
+            xi = np.float64(x[i])
+            zi = np.float64(z[i])
+            txi = np.float64(tx[i])
+            tzi = np.float64(tz[i])
+            if xmin <= xi <= xmax:  # faux pour NaN
+                nx += 1
+                sx += xi
+                sxx += xi*xi
+                if tmin <= txi <= tmax:
+                    nex += 1
+                    ex += xi
+                    etx += txi
+                    exx += xi*xi
+                    etxx += txi*txi
+                    extx += xi*txi
+            if xmin <= zi <= xmax:
+                nz += 1
+                sz += zi
+                szz += zi*zi
+                if tmin <= tzi <= tmax:
+                    nez += 1
+                    ez += zi
+                    etz += tzi
+                    ezz += zi*zi
+                    etzz += tzi*tzi
+                    eztz += zi*tzi
+        return np.array([nx, sx, sxx, nz, sz, szz,
+                         nex, ex, etx, exx, etxx, extx,
+                         nez, ez, etz, ezz, etzz, eztz])
+else:
+    def emittance_moments(x, theta, xmin, xmax, tmin, tmax):
+        # Les comparaisons rejettent déjà NaN/inf, pas besoin de np.isfinite
+        mask = (x >= xmin) & (x <= xmax) & (theta >= tmin) & (theta <= tmax)
+        # float64 après masquage : en float32, np.dot (sdot) ruine la formule
+        # Σx² - n·m² dès que le faisceau est décentré
+        x = x[mask].astype(np.float64)
+        theta = theta[mask].astype(np.float64)
+        # Trois produits scalaires (BLAS) : ni vstack ni np.cov
+        return np.array([x.size, x.sum(), theta.sum(),
+                         np.dot(x, x), np.dot(theta, theta), np.dot(x, theta)])
+
+    def rms_moments(x, lo, hi):
+        x = x[(x >= lo) & (x <= hi)].astype(np.float64)  # rejette aussi NaN/inf
+        # Σx² via np.dot (BLAS) : pas de tableau (x - mean)**2
+        return np.array([x.size, x.sum(), np.dot(x, x)])
+
+    def phase_space_moments(x, z, tx, tz, xmin, xmax, tmin, tmax):
+        return np.concatenate([rms_moments(x, xmin, xmax), rms_moments(z, xmin, xmax),
+                               emittance_moments(x, tx, xmin, xmax, tmin, tmax),
+                               emittance_moments(z, tz, xmin, xmax, tmin, tmax)])
+
+def compute_emittance_and_twiss(moments):
+    n, sx, st, sxx, stt, sxt = moments
+    if n < 2:
         return np.nan, np.nan, np.nan, np.nan
-    cov = np.cov(np.vstack([x, theta]), ddof=1)
-    sig_x2, sig_xt = cov[0,0], cov[0,1]
-    sig_t2 = cov[1,1]
+    mx, mt = sx/n, st/n
+    sig_x2 = (sxx - n*mx*mx) / (n-1)
+    sig_t2 = (stt - n*mt*mt) / (n-1)
+    sig_xt = (sxt - n*mx*mt) / (n-1)
     det = sig_x2*sig_t2 - sig_xt**2
     eps = np.sqrt(det) if det > 0 else np.nan
     alpha = -sig_xt/eps if eps > 0 else np.nan
@@ -53,132 +142,237 @@ def compute_emittance_and_twiss(x, theta):
     gamma = sig_t2/eps if eps > 0 else np.nan
     return eps, alpha, beta, gamma
 
-def compute_rms_size(x):
-    mask = np.isfinite(x) & (x >= pos_lim[0]) & (x <= pos_lim[1])
-    x = x[mask]
-    if len(x) == 0:
+def compute_rms_size(moments):
+    n, s, ss = moments
+    if n == 0:
         return np.nan
-    return np.sqrt(np.mean((x-np.mean(x))**2))
-
-# --- Tracer une ligne pour le tree Input ---
+    mean = s/n
+    return np.sqrt(max(0.0, ss/n - mean*mean))
+
+# --- Accumulateurs (histogrammes + sommes) pour un jeu x, z, θx, θz ---
+def new_phase_space(xz_lim):
+    return {
+        "xz_lim": xz_lim,
+        "H_xz": np.zeros((bins_pos, bins_pos)),
+        "H_x": np.zeros((bins_pos, bins_angle)),
+        "H_z": np.zeros((bins_pos, bins_angle)),
+        "rms_x": np.zeros(3),
+        "rms_z": np.zeros(3),
+        "emit_x": np.zeros(6),
+        "emit_z": np.zeros(6),
+    }
+
+def to_device(*arrays):
+    # Copie unique sur GPU d'un bloc entier (tous les (q, stage) d'un coup pour les
+    # quadrupoles), si CuPy est là et le bloc assez gros pour amortir le transfert
+    if cp is None or arrays[0].size < gpu_min_entries:
+        return arrays
+    return tuple(cp.asarray(a) for a in arrays)
+
+def hist2d_counts(x, y, bins, rng):
+    if cp is not None and isinstance(x, cp.ndarray):
+        # Comme fast_histogram, bins semi-ouverts [lo, hi[ : cp.histogram2d (sémantique
+        # NumPy) compterait les valeurs égales au bord haut dans le dernier bin
+        keep = (x < rng[0][1]) & (y < rng[1][1])
+        # Seule la matrice des comptages revient sur l'hôte
+        return cp.histogram2d(x[keep], y[keep], bins=bins, range=rng)[0].get()
+    # Bins uniformes : fast_histogram évite le searchsorted de np.histogram2d
+    return histogram2d(x, y, bins=bins, range=rng)
+
+def fill_phase_space(acc, x, z, theta_x, theta_z, device=None):
+    # device : mêmes tableaux déjà copiés sur GPU par l'appelant (sinon copie ici)
+    xd, zd, txd, tzd = device if device is not None else to_device(x, z, theta_x, theta_z)
+    acc["H_xz"] += hist2d_counts(xd, zd, bins_pos, acc["xz_lim"])
+    acc["H_x"] += hist2d_counts(xd, txd, [bins_pos, bins_angle], [pos_lim, angle_lim_mrad])
+    acc["H_z"] += hist2d_counts(zd, tzd, [bins_pos, bins_angle], [pos_lim, angle_lim_mrad])
+    m = phase_space_moments(x, z, theta_x, theta_z, *pos_lim, *angle_lim_mrad)
+    acc["rms_x"] += m[0:3]
+    acc["rms_z"] += m[3:6]
+    acc["emit_x"] += m[6:12]
+    acc["emit_z"] += m[12:18]
+
+def log_counts(H):
+    # log10 calculé une fois en NumPy plutôt que par LogNorm au rendu ;
+    # les bins vides (NaN) restent transparents comme avec LogNorm
+    Hlog = np.full(H.T.shape, np.nan, dtype=np.float32)
+    np.log10(H.T, out=Hlog, where=H.T > 0)
+    return Hlog
+
+def show_hist2d(ax, H, rng, **kw):
+    # Grille uniforme : une seule image (pas de QuadMesh), bins affichés tels quels
+    # sans le filtre d'antialiasing appliqué par défaut au sous-échantillonnage
+    kw.setdefault("cmap", "viridis")
+    kw.setdefault("interpolation", "nearest")
+    return ax.imshow(log_counts(H), origin="lower", aspect="auto",
+                     extent=[rng[0][0], rng[0][1], rng[1][0], rng[1][1]], **kw)
+
+# Graduations 1-2-5 (en log10) : la colorbar reste lisible même sur moins d'une décade
+count_ticks = np.log10(np.outer(10.0**np.arange(10), [1, 2, 5]).ravel())
+
+def add_colorbar(fig, img, ax):
+    # Échelle linéaire en log10(counts), graduée en nombre de counts
+    return fig.colorbar(img, ax=ax, label="Counts", ticks=FixedLocator(count_ticks),
+                        format=FuncFormatter(lambda v, pos: f"{10**v:.0f}"))
+
+# --- Lecture par blocs ---
+def iterate_tree(tree, branches, library="np"):
+    # Le bloc suivant est lu en tâche de fond pendant le traitement du bloc courant
+    batches = tree.iterate(filter_name=branches, step_size=step_size, library=library)
+    with ThreadPoolExecutor(max_workers=1) as reader:
+        pending = reader.submit(next, batches, None)
+        while (batch := pending.result()) is not None:
+            pending = reader.submit(next, batches, None)
+            yield batch
+
+def stream_coll(tree):
+    H = np.zeros((bins_pos, bins_pos))
+    for batch in iterate_tree(tree, branches_coll):
+        H += histogram2d(batch["x_interaction"], batch["z_interaction"],
+                         bins=bins_pos, range=[pos_lim, pos_lim])
+    return H
+
+yag_lim = [(-5,5),(-340,-250)]
+
+def energy_spectrum(tree):
+    # Le binning dépend du max global de l'énergie Input : il est fixé ici, puis
+    # partagé avec le spectre YAG et les vues linéaire/log
+    energy_input = tree["energy"].array(library="np")
+    emax = float(energy_input.max())
+    energy_bins = np.linspace(0.0, emax, 101)
+    counts, _ = np.histogram(energy_input, bins=energy_bins)
+    return energy_bins, counts
+
+def stream_yag(tree, fut_spectrum):
+    # Branches jagged : ak.flatten donne directement le contenu contigu,
+    # sans boucle Python sur les events. L'énergie est binnée bloc par bloc :
+    # aucun tableau aplati n'est conservé ni concaténé.
+    H = np.zeros((bins_pos, bins_pos))
+    energy_bins = fut_spectrum.result()[0]
+    counts = np.zeros(len(energy_bins) - 1, dtype=np.int64)
+    for batch in iterate_tree(tree, branches_yag, library="ak"):
+        x_yag = ak.to_numpy(ak.flatten(batch["x_exit"]))
+        z_yag = ak.to_numpy(ak.flatten(batch["z_exit"]))
+        H += histogram2d(x_yag, z_yag, bins=bins_pos, range=yag_lim)
+        counts += np.histogram(ak.to_numpy(ak.flatten(batch["energy"])), bins=energy_bins)[0]
+    return H, counts
+
+# Coll, YAG et énergie Input (ni Numba ni CuPy) sont lus dans des threads pendant
+# que le thread principal traite Input et QuadrupolesTracking.
+# Le spectre Input est soumis en premier : stream_yag attend son binning.
+background = ThreadPoolExecutor(max_workers=4)
+fut_spectrum = background.submit(energy_spectrum, tree_input)
+fut_hc = background.submit(stream_coll, tree_horizontalcoll)
+fut_vc = background.submit(stream_coll, tree_verticalcoll)
+fut_yag = background.submit(stream_yag, tree_yag, fut_spectrum)
+
+# --- Tree Input ---
+Ntot = tree_input.num_entries
+input_ps = new_phase_space([(-0.1,0.1),(-0.1,0.1)])
+for batch in iterate_tree(tree_input, branches_input):
+    # float32 : précision suffisante pour le binning, moitié moins d'octets à parcourir
+    x, z, xp, zp = (batch[k].astype(np.float32, copy=False) for k in branches_input)
+    fill_phase_space(input_ps, x, z, xp * 1000, zp * 1000)  # mrad
+
+# --- Tree QuadrupolesTracking ---
+keys = [(q, stage) for q in quads for stage in stages]
+quads_ps = [new_phase_space([pos_lim, pos_lim]) for _ in keys]
+for batch in iterate_tree(tree_quads, branches_quads):
+    # Regroupement des branches quadrupoles (un bloc par (q, stage)),
+    # converties en float32 pendant la copie
+    Xs = np.stack([batch[f"{q}{stage}Pos_x"] for q, stage in keys], dtype=np.float32)
+    Zs = np.stack([batch[f"{q}{stage}Pos_z"] for q, stage in keys], dtype=np.float32)
+    My = np.stack([batch[f"{q}{stage}Mom_y"] for q, stage in keys], dtype=np.float32)
+    Tx = np.stack([batch[f"{q}{stage}Mom_x"] for q, stage in keys], dtype=np.float32)
+    Tz = np.stack([batch[f"{q}{stage}Mom_z"] for q, stage in keys], dtype=np.float32)
+    # Angles en mrad, calculés sur place pour éviter les temporaires
+    np.divide(Tx, My, out=Tx)
+    Tx *= 1000.0
+    np.divide(Tz, My, out=Tz)
+    Tz *= 1000.0
+    # Le seuil GPU porte sur le bloc complet (8 x entrées), copié une seule fois
+    Xd, Zd, Txd, Tzd = to_device(Xs, Zs, Tx, Tz)
+    for i in range(len(keys)):
+        fill_phase_space(quads_ps[i], Xs[i], Zs[i], Tx[i], Tz[i],
+                         device=(Xd[i], Zd[i], Txd[i], Tzd[i]))
+    del batch, Xs, Zs, My, Tx, Tz, Xd, Zd, Txd, Tzd
+
+# --- Résultats des lectures en tâche de fond ---
+H_hc = fut_hc.result()
+H_vc = fut_vc.result()
+H_yag, counts_yag = fut_yag.result()
+energy_bins, counts_input = fut_spectrum.result()
+background.shutdown()
+
+# --- Figures ---
+# bbox_inches="tight" : les labels plus longs des quadrupoles ne sont pas rognés
+savefig_kw = dict(dpi=100, bbox_inches="tight")
+
+# --- Figure 1x3 réutilisée pour Input puis pour chaque (q, stage) ---
 fig, axes = plt.subplots(1, 3, figsize=(18,5))
+panels = []
+for ax in axes:
+    img = show_hist2d(ax, np.ones((bins_pos, bins_angle)), [pos_lim, angle_lim_mrad])
+    add_colorbar(fig, img, ax)
+    txt = ax.text(0.05, 0.95, "", transform=ax.transAxes, ha="left", va="top",
+                  color="white", bbox=dict(facecolor="black", alpha=0.5))
+    panels.append((img, txt))
+
+def update_panel(panel, H, rng, xlabel, ylabel, title, text):
+    # Mise à jour des artistes existants : ni nouvel Axes ni nouvelle colorbar
+    img, txt = panel
+    img.set_data(log_counts(H))
+    img.set_extent([rng[0][0], rng[0][1], rng[1][0], rng[1][1]])
+    img.autoscale()
+    img.axes.set_xlabel(xlabel)
+    img.axes.set_ylabel(ylabel)
+    img.axes.set_title(title)
+    txt.set_text(text)
+    txt.set_visible(bool(text))
+
+def emittance_text(eps, alpha, beta):
+    if np.isnan(eps):
+        return ""
+    return f"ε={eps:.3f} mm·mrad\nα={alpha:.2f}, β={beta:.2f}"
+
+def draw_phase_space(ps, name, label_x, label_z, label_tx, label_tz):
+    rms_x = compute_rms_size(ps["rms_x"])
+    rms_z = compute_rms_size(ps["rms_z"])
+    eps_x, alpha_x, beta_x, gamma_x = compute_emittance_and_twiss(ps["emit_x"])
+    eps_z, alpha_z, beta_z, gamma_z = compute_emittance_and_twiss(ps["emit_z"])
+
+    # Positions X-Z
+    update_panel(panels[0], ps["H_xz"], ps["xz_lim"], label_x, label_z,
+                 f"{name} Positions X-Z",
+                 f"RMS x={rms_x:.3f} mm\nRMS z={rms_z:.3f} mm")
+    # Emittance X (x vs θx)
+    update_panel(panels[1], ps["H_x"], [pos_lim, angle_lim_mrad], label_x, label_tx,
+                 f"{name} Emittance X", emittance_text(eps_x, alpha_x, beta_x))
+    # Emittance Z (z vs θz)
+    update_panel(panels[2], ps["H_z"], [pos_lim, angle_lim_mrad], label_z, label_tz,
+                 f"{name} Emittance Z", emittance_text(eps_z, alpha_z, beta_z))
 
-# Positions X-Z
-x = data_input["x"]
-z = data_input["z"]
-Ntot = len(x)
-rms_x = compute_rms_size(x)
-rms_z = compute_rms_size(z)
-h = axes[0].hist2d(x, z, bins=bins_pos, range=[(-0.1,0.1),(-0.1,0.1)],
-                    cmap='viridis', norm=LogNorm())
-axes[0].set_xlabel("x [mm]")
-axes[0].set_ylabel("z [mm]")
-axes[0].set_title("Input Positions X-Z")
-fig.colorbar(h[3], ax=axes[0], label="Counts")
-axes[0].text(0.05, 0.95, f"RMS x={rms_x:.3f} mm\nRMS z={rms_z:.3f} mm",
-             transform=axes[0].transAxes, ha="left", va="top",
-             color="white", bbox=dict(facecolor="black", alpha=0.5))
-
-# Emittance X (x vs xp)
-theta_x = data_input["xp"] * 1000  # mrad
-eps_x, alpha_x, beta_x, gamma_x = compute_emittance_and_twiss(x, theta_x)
-h = axes[1].hist2d(x, theta_x, bins=[bins_pos, bins_angle],
-                    range=[pos_lim, angle_lim_mrad],
-                    cmap='viridis', norm=LogNorm())
-axes[1].set_xlabel("x [mm]")
-axes[1].set_ylabel("θ_x [mrad]")
-axes[1].set_title("Input Emittance X")
-fig.colorbar(h[3], ax=axes[1], label="Counts")
-if not np.isnan(eps_x):
-    axes[1].text(0.05, 0.95, f"ε={eps_x:.3f} mm·mrad\nα={alpha_x:.2f}, β={beta_x:.2f}",
-                 transform=axes[1].transAxes, ha="left", va="top",
-                 color="white", bbox=dict(facecolor="black", alpha=0.5))
-
-# Emittance Z (z vs zp)
-theta_z = data_input["zp"] * 1000  # mrad
-eps_z, alpha_z, beta_z, gamma_z = compute_emittance_and_twiss(z, theta_z)
-h = axes[2].hist2d(z, theta_z, bins=[bins_pos, bins_angle],
-                    range=[pos_lim, angle_lim_mrad],
-                    cmap='viridis', norm=LogNorm())
-axes[2].set_xlabel("z [mm]")
-axes[2].set_ylabel("θ_z [mrad]")
-axes[2].set_title("Input Emittance Z")
-fig.colorbar(h[3], ax=axes[2], label="Counts")
-if not np.isnan(eps_z):
-    axes[2].text(0.05, 0.95, f"ε={eps_z:.3f} mm·mrad\nα={alpha_z:.2f}, β={beta_z:.2f}",
-                 transform=axes[2].transAxes, ha="left", va="top",
-                 color="white", bbox=dict(facecolor="black", alpha=0.5))
-
-plt.tight_layout()
-plt.show()
+# --- Tracer une ligne pour le tree Input ---
+draw_phase_space(input_ps, "Input", "x [mm]", "z [mm]", "θ_x [mrad]", "θ_z [mrad]")
+fig.tight_layout()
+fig.savefig("Input.png", **savefig_kw)
 
 # --- Boucle pour chaque quadrupole et stage ---
-for q in quads:
-    for stage in stages:
-        fig, axes = plt.subplots(1, 3, figsize=(18,5))
-
-        # ---- Positions X-Z ----
-        x = data_quads[f"{q}{stage}Pos_x"]
-        z = data_quads[f"{q}{stage}Pos_z"]
-        rms_x = compute_rms_size(x)
-        rms_z = compute_rms_size(z)
-        h = axes[0].hist2d(x, z, bins=bins_pos, range=[pos_lim,pos_lim],
-                            cmap='viridis', norm=LogNorm())
-        axes[0].set_xlabel(f"{q}{stage}Pos_x [mm]")
-        axes[0].set_ylabel(f"{q}{stage}Pos_z [mm]")
-        axes[0].set_title(f"{q} {stage} Positions X-Z")
-        fig.colorbar(h[3], ax=axes[0], label="Counts")
-        axes[0].text(0.05, 0.95, f"RMS x={rms_x:.3f} mm\nRMS z={rms_z:.3f} mm",
-                     transform=axes[0].transAxes, ha="left", va="top",
-                     color="white", bbox=dict(facecolor="black", alpha=0.5))
-
-        # ---- Emittance X-θx ----
-        theta_x = data_quads[f"{q}{stage}Mom_x"] / data_quads[f"{q}{stage}Mom_y"] * 1000  # mrad
-        eps_x, alpha_x, beta_x, gamma_x = compute_emittance_and_twiss(x, theta_x)
-        h = axes[1].hist2d(x, theta_x, bins=[bins_pos, bins_angle],
-                            range=[pos_lim, angle_lim_mrad],
-                            cmap='viridis', norm=LogNorm())
-        axes[1].set_xlabel(f"{q}{stage}Pos_x [mm]")
-        axes[1].set_ylabel(f"{q}{stage}θ_x [mrad]")
-        axes[1].set_title(f"{q} {stage} Emittance X")
-        fig.colorbar(h[3], ax=axes[1], label="Counts")
-        if not np.isnan(eps_x):
-            axes[1].text(0.05, 0.95, f"ε={eps_x:.3f} mm·mrad\nα={alpha_x:.2f}, β={beta_x:.2f}",
-                         transform=axes[1].transAxes, ha="left", va="top",
-                         color="white", bbox=dict(facecolor="black", alpha=0.5))
-
-        # ---- Emittance Z-θz ----
-        theta_z = data_quads[f"{q}{stage}Mom_z"] / data_quads[f"{q}{stage}Mom_y"] * 1000  # mrad
-        eps_z, alpha_z, beta_z, gamma_z = compute_emittance_and_twiss(z, theta_z)
-        h = axes[2].hist2d(z, theta_z, bins=[bins_pos, bins_angle],
-                            range=[pos_lim, angle_lim_mrad],
-                            cmap='viridis', norm=LogNorm())
-        axes[2].set_xlabel(f"{q}{stage}Pos_z [mm]")
-        axes[2].set_ylabel(f"{q}{stage}θ_z [mrad]")
-        axes[2].set_title(f"{q} {stage} Emittance Z")
-        fig.colorbar(h[3], ax=axes[2], label="Counts")
-        if not np.isnan(eps_z):
-            axes[2].text(0.05, 0.95, f"ε={eps_z:.3f} mm·mrad\nα={alpha_z:.2f}, β={beta_z:.2f}",
-                         transform=axes[2].transAxes, ha="left", va="top",
-                         color="white", bbox=dict(facecolor="black", alpha=0.5))
-
-plt.tight_layout()
-plt.show()
+for (q, stage), ps in zip(keys, quads_ps):
+    draw_phase_space(ps, f"{q} {stage}",
+                     f"{q}{stage}Pos_x [mm]", f"{q}{stage}Pos_z [mm]",
+                     f"{q}{stage}θ_x [mrad]", f"{q}{stage}θ_z [mrad]")
+    fig.savefig(f"{q}_{stage}.png", **savefig_kw)
+plt.close(fig)  # libère la figure 1x3 (images 500x500 et état du renderer)
 
 
 # --- Tracer une ligne pour les trees Coll/YAG ---
 fig, axes = plt.subplots(1, 2, figsize=(12,4))
 
 # Positions X-Z Horizontal Coll
-x_hc = data_horizontalcoll["x_interaction"]
-z_hc = data_horizontalcoll["z_interaction"]
+# Une entrée par particule arrêtée : le nombre d'entrées suffit, sans lecture
+frac_stopped_hc = tree_horizontalcoll.num_entries / Ntot * 100  # pourcentage
 
-frac_stopped_hc = len(x_hc) / Ntot * 100  # pourcentage
-
-h = axes[0].hist2d(
-    x_hc, z_hc, bins=bins_pos, range=[pos_lim, pos_lim],
-    cmap="viridis", norm=LogNorm()
-)
+img = show_hist2d(axes[0], H_hc, [pos_lim, pos_lim])
 axes[0].set_xlabel("x [mm]")
 axes[0].set_ylabel("z [mm]")
 axes[0].set_title("Horizontal Collimators Positions X-Z")
@@ -188,21 +382,18 @@ axes[0].annotate(
     f"{frac_stopped_hc:.2f}% flux stopped by horizontal collimators",
     xy=(0.02, 0.95), xycoords="axes fraction",   # coordonnées relatives à l'axe
     fontsize=11, color="white",
-    ha="left", va="top", 
+    ha="left", va="top",
     bbox=dict(facecolor="black", alpha=0.5, edgecolor="none")  # fond noir translucide
 )
 
-fig.colorbar(h[3], ax=axes[0], label="Counts")
+add_colorbar(fig, img, axes[0])
 
 
 
 
 # Positions X-Z Vertical Coll
-x_vc = data_verticalcoll["x_interaction"]
-z_vc = data_verticalcoll["z_interaction"]
-frac_stopped_vc = len(x_vc) / Ntot * 100  # pourcentage
-h = axes[1].hist2d(x_vc, z_vc, bins=bins_pos,range=[pos_lim,pos_lim],
-                    cmap='viridis', norm=LogNorm())
+frac_stopped_vc = tree_verticalcoll.num_entries / Ntot * 100  # pourcentage
+img = show_hist2d(axes[1], H_vc, [pos_lim, pos_lim])
 axes[1].set_xlabel("x [mm]")
 axes[1].set_ylabel("z [mm]")
 axes[1].set_title("Vertical Collimators X-Z")
@@ -211,38 +402,28 @@ axes[1].annotate(
     f"{frac_stopped_vc:.2f}% flux stopped by vertical collimators",
     xy=(0.02, 0.95), xycoords="axes fraction",   # coordonnées relatives à l'axe
     fontsize=11, color="white",
-    ha="left", va="top", 
+    ha="left", va="top",
     bbox=dict(facecolor="black", alpha=0.5, edgecolor="none")  # fond noir translucide
 )
-fig.colorbar(h[3], ax=axes[1], label="Counts")
+add_colorbar(fig, img, axes[1])
 
-plt.tight_layout()
-plt.show()
+fig.tight_layout()
+fig.savefig("Collimators.png", **savefig_kw)
+plt.close(fig)
 
 fig, axes = plt.subplots(1, 3, figsize=(18,5))
 
 # Positions X-Z YAG
-x_yag = np.concatenate([arr for arr in data_yag["x_exit"]])
-z_yag = np.concatenate([arr for arr in data_yag["z_exit"]])
-
-print(x_yag)
-h = axes[0].hist2d(x_yag, z_yag, bins=bins_pos,range=[(-5,5),(-340,-250)],
-                    cmap='viridis', norm=LogNorm())
+img = show_hist2d(axes[0], H_yag, yag_lim)
 axes[0].set_xlabel("x [mm]")
 axes[0].set_ylabel("z [mm]")
 axes[0].set_title("YAG Positions X-Z")
-fig.colorbar(h[3], ax=axes[0], label="Counts")
+add_colorbar(fig, img, axes[0])
 
 # --- Plot 2 : Histogramme d'énergie Input vs YAG ---
-energy_input = np.array(data_input["energy"])         # déjà ok
-energy_yag   = np.concatenate(data_yag["energy"])     # aplatit la liste d'arrays
-
 # Histogramme comparatif
-axes[1].hist(energy_input, bins=100, range=(0, np.max(energy_input)),
-             histtype="step", color="blue", label="Input Energy")
-
-axes[1].hist(energy_yag, bins=100, range=(0, np.max(energy_input)),
-             histtype="step", color="red", label="YAG Energy")
+axes[1].stairs(counts_input, energy_bins, color="blue", label="Input Energy")
+axes[1].stairs(counts_yag, energy_bins, color="red", label="YAG Energy")
 
 # Mise en forme
 axes[1].set_xlabel("Energy [MeV]")
@@ -250,14 +431,9 @@ axes[1].set_ylabel("Counts")
 axes[1].set_title("Energy Distribution (Input vs YAG)")
 axes[1].legend()
 
-# --- Plot 2 : Histogramme d'énergie Input vs YAG ---
-
-# Histogramme comparatif
-axes[2].hist(energy_input, bins=100, range=(0, np.max(energy_input)),
-             histtype="step", color="blue", label="Input Energy")
-
-axes[2].hist(energy_yag, bins=100, range=(0, np.max(energy_input)),
-             histtype="step", color="red", label="YAG Energy")
+# --- Plot 3 : même histogramme en échelle log ---
+axes[2].stairs(counts_input, energy_bins, color="blue", label="Input Energy")
+axes[2].stairs(counts_yag, energy_bins, color="red", label="YAG Energy")
 
 # Mise en forme
 axes[2].set_xlabel("Energy [MeV]")
@@ -266,10 +442,14 @@ axes[2].set_title("Energy Distribution (Input vs YAG)")
 axes[2].set_yscale("log")
 axes[2].legend()
 
-plt.tight_layout()
-plt.show()
+fig.tight_layout()
+fig.savefig("YAG.png", **savefig_kw)
+plt.close(fig)
 
 
 # --- Nettoyage mémoire ---
-del data_input, data_quads, tree_input, tree_quads, file
+del input_ps, quads_ps, H_hc, H_vc, H_yag, counts_input, counts_yag
+decompression_executor.shutdown()
+interpretation_executor.shutdown()
+del tree_input, tree_quads, tree_horizontalcoll, tree_verticalcoll, tree_yag, file
 gc.collect()